@@ -5,8 +5,12 @@ Reads documents from shared Dropbox folder, shows structured reports,
 and lets family members ask questions and create reports via AI.
 """
 
+import io
 import json
+import logging
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
 import anthropic
@@ -17,14 +21,18 @@ load_dotenv(".env.local")
 
 from scan import (
     get_dropbox_client,
+    get_dropbox_credentials,
     get_dropbox_fingerprint,
+    list_app_data,
     load_app_data,
-    parse_assets,
-    parse_heirs,
-    save_app_data,
+    parse_documents,
+    save_app_data_async,
     scan_dropbox,
+    watch_dropbox,
 )
 
+logger = logging.getLogger(__name__)
+
 # --- Config ---
 st.set_page_config(
     page_title="Inheritance",
@@ -32,97 +40,265 @@ st.set_page_config(
     layout="wide",
 )
 
+# --- Secrets ---
+try:
+    ANTHROPIC_API_KEY = st.secrets.get("ANTHROPIC_API_KEY", "") or os.environ.get("ANTHROPIC_API_KEY", "")
+except Exception:
+    ANTHROPIC_API_KEY = os.environ.get("ANTHROPIC_API_KEY", "")
+
 # --- State Init ---
 for key, default in [
     ("messages", []),
     ("data", None),
     ("dropbox_fingerprint", None),
-    ("reports", []),
+    ("dropbox_changes_seen", 0),
+    ("documents_retry_at", None),
+    ("reports", {}),
     ("notes", []),
     ("interview", []),
+    ("history_summary", {"upto": 0, "text": ""}),
+    ("chat_saved_count", 0),
+    ("chat_save_disabled", False),
+    ("chat_visible", 50),
+    ("state_version", 0),
     ("initialized", False),
 ]:
     if key not in st.session_state:
         st.session_state[key] = default
 
 
-def load_documents():
-    """Scan Dropbox via API and parse data."""
-    dbx = get_dropbox_client()
+@st.cache_resource(show_spinner=False)
+def _dbx_for(credentials):
+    """One authenticated Dropbox client per credential set, shared across reruns and sessions."""
+    return get_dropbox_client(credentials)
+
+
+def _cached_dbx():
+    """Return the shared Dropbox client; rotated secrets get a fresh one."""
+    return _dbx_for(get_dropbox_credentials())
+
+
+DOCUMENTS_RETRY = timedelta(seconds=30)  # wait before retrying a failed scan
+
+
+def load_documents(dbx=None, fingerprint=None):
+    """Scan Dropbox via API and parse data.
+
+    Callers that already hold a client or a fresh fingerprint pass them in
+    to avoid a second folder listing.
+    """
+    dbx = dbx or _cached_dbx()
     if not dbx:
         return None
-    documents = scan_dropbox(dbx)
-    st.session_state.dropbox_fingerprint = get_dropbox_fingerprint(dbx)
+    data = st.session_state.get("data")
+    prior_docs = {doc["path"]: doc for doc in data["documents"]} if data else None
+    try:
+        if fingerprint is None:
+            fingerprint = get_dropbox_fingerprint(dbx)
+        if fingerprint is None:
+            raise RuntimeError("could not list the Dropbox folder")
+        loaded = _load_documents_for(fingerprint, prior_docs)
+    except Exception as e:
+        # Nothing was cached; keep what the session has and let the poller retry
+        logger.warning("Dropbox scan failed, keeping current documents: %s", e)
+        st.session_state.documents_retry_at = datetime.now() + DOCUMENTS_RETRY
+        return data
+    st.session_state.dropbox_fingerprint = fingerprint
+    st.session_state.documents_retry_at = None
+    return loaded
+
+
+@st.cache_data(max_entries=2, show_spinner=False)
+def _load_documents_for(fingerprint, _prior_docs=None):
+    """Scan and parse documents once per Dropbox fingerprint, shared across sessions.
+
+    Unchanged documents from the previous scan are reused instead of re-read.
+    The scan is strict: a listing or download error raises, and st.cache_data
+    doesn't cache exceptions, so a partial result is never shared.
+    """
+    documents = scan_dropbox(_cached_dbx(), prior_docs=_prior_docs, strict=True)
+    parsed = [
+        _parse_document(doc["path"], doc["content_hash"], doc) if doc.get("content_hash")
+        else parse_documents([doc])
+        for doc in documents
+    ]
     return {
         "scan_date": datetime.now().isoformat(),
         "documents": documents,
-        "heirs": parse_heirs(documents),
-        "assets": parse_assets(documents),
+        "heirs": [heir for heirs, _ in parsed for heir in heirs],
+        "assets": [asset for _, assets in parsed for asset in assets],
     }
 
 
+@st.cache_data(max_entries=1024, show_spinner=False)
+def _parse_document(path, content_hash, _doc):
+    """Heirs and assets of one document, parsed once per path and content hash."""
+    return parse_documents([_doc])
+
+
+CHAT_SEGMENT_SIZE = 100  # messages per chat_history_NNNN.json file
+
+
+def _chat_segment_name(n):
+    return f"chat_history_{n:04d}.json"
+
+
+def _load_chat_history(dbx):
+    """Return (messages, number already stored in segment files), or None if loading failed.
+
+    Segment indices are derived from the loaded count, so a partial history
+    must not be returned: saving from it would overwrite stored segments.
+    """
+    stored = list_app_data(dbx, "chat_history")
+    if stored is None:
+        return None
+    names = [name for name in stored if name.startswith("chat_history_")]
+    if not names:
+        if "chat_history.json" not in stored:
+            return [], 0
+        # Legacy single-file history; the next save rewrites it as segments
+        legacy = load_app_data(dbx, "chat_history.json")
+        return (legacy, 0) if legacy is not None else None
+    with ThreadPoolExecutor(max_workers=min(len(names), 8)) as pool:
+        segments = list(pool.map(lambda name: load_app_data(dbx, name), names))
+    if any(segment is None for segment in segments):
+        return None
+    messages = [m for segment in segments for m in segment]
+    return messages, len(messages)
+
+
 def load_persistent_data():
-    """Load chat history, reports, notes, and interview from Dropbox."""
-    dbx = get_dropbox_client()
+    """Load chat history, reports, notes, interview, and history summary from Dropbox."""
+    dbx = _cached_dbx()
     if not dbx:
         return
-    for key, filename in [
-        ("messages", "chat_history.json"),
+    files = [
         ("reports", "reports.json"),
         ("notes", "notes.json"),
         ("interview", "interview.json"),
-    ]:
-        data = load_app_data(dbx, filename)
-        if data:
-            st.session_state[key] = data
+        ("history_summary", "history_summary.json"),
+    ]
+    # Independent downloads: fetch them concurrently, apply results here
+    with ThreadPoolExecutor(max_workers=len(files) + 1) as pool:
+        chat = pool.submit(_load_chat_history, dbx)
+        futures = {pool.submit(load_app_data, dbx, filename): key for key, filename in files}
+        for future in as_completed(futures):
+            key = futures[future]
+            data = future.result()
+            if data:
+                if key == "reports":
+                    # Stored as a list; kept in memory keyed by section id
+                    data = {s["id"]: s for s in data}
+                st.session_state[key] = data
+        chat_history = chat.result()
+    if chat_history is None:
+        logger.warning("Chat history could not be loaded; chat saving disabled for this session")
+        st.session_state.chat_save_disabled = True
+        # The stored summary indexes into the history we couldn't load
+        st.session_state.history_summary = {"upto": 0, "text": ""}
+        return
+    messages, saved_count = chat_history
+    if messages:
+        st.session_state.messages = messages
+    st.session_state.chat_saved_count = saved_count
 
 
-def _save(filename, key):
-    dbx = get_dropbox_client()
+def _save(filename, data):
+    dbx = _cached_dbx()
     if dbx:
-        save_app_data(dbx, filename, st.session_state[key])
+        save_app_data_async(dbx, filename, data)
 
 
 def save_chat_history():
-    _save("chat_history.json", "messages")
+    """Upload only the chat segments that gained messages since the last save."""
+    messages = st.session_state.messages
+    if not messages or st.session_state.chat_save_disabled:
+        return
+    first = st.session_state.chat_saved_count // CHAT_SEGMENT_SIZE
+    last = (len(messages) - 1) // CHAT_SEGMENT_SIZE
+    for n in range(first, last + 1):
+        start = n * CHAT_SEGMENT_SIZE
+        _save(_chat_segment_name(n), messages[start:start + CHAT_SEGMENT_SIZE])
+    st.session_state.chat_saved_count = len(messages)
 
 
 def save_reports():
-    _save("reports.json", "reports")
+    _save("reports.json", list(st.session_state.reports.values()))
 
 
 def save_notes():
-    _save("notes.json", "notes")
+    _save("notes.json", st.session_state.notes)
 
 
 def save_interview():
-    _save("interview.json", "interview")
+    _save("interview.json", st.session_state.interview)
+
+
+def save_history_summary():
+    if st.session_state.chat_save_disabled:
+        return
+    _save("history_summary.json", st.session_state.history_summary)
+
+
+def _dropbox_changes():
+    return _dropbox_changes_for(get_dropbox_credentials())
+
+
+@st.cache_resource(show_spinner=False)
+def _dropbox_changes_for(credentials):
+    """Process-wide change counter, bumped by a background Dropbox longpoll thread."""
+    changes = {"count": 0}
+    dbx = _dbx_for(credentials)
+    if dbx:
+        def bump():
+            changes["count"] += 1
+        watch_dropbox(dbx, bump)
+    return changes
 
 
 # --- Auto-load on first open ---
 if not st.session_state.initialized:
     with st.spinner("Loading from Dropbox..."):
+        st.session_state.dropbox_changes_seen = _dropbox_changes()["count"]
         st.session_state.data = load_documents()
         load_persistent_data()
         st.session_state.initialized = True
 
 
-# --- Poll Dropbox for document changes every 30 seconds ---
-@st.fragment(run_every=timedelta(seconds=30))
+# --- Reload documents when the longpoll thread reports a Dropbox change ---
+@st.fragment(run_every=timedelta(seconds=2))
 def _poll_dropbox():
-    dbx = get_dropbox_client()
+    changes = _dropbox_changes()["count"]
+    retry_at = st.session_state.documents_retry_at
+    retry_due = retry_at is not None and datetime.now() >= retry_at
+    if changes == st.session_state.dropbox_changes_seen and not retry_due:
+        return
+    st.session_state.dropbox_changes_seen = changes
+    dbx = _cached_dbx()
     if not dbx:
         return
     fingerprint = get_dropbox_fingerprint(dbx)
-    if fingerprint and fingerprint != st.session_state.dropbox_fingerprint:
-        st.session_state.data = load_documents()
-        st.rerun(scope="app")
+    if fingerprint is None:
+        # The change is already marked seen; only the retry will pick it up
+        st.session_state.documents_retry_at = datetime.now() + DOCUMENTS_RETRY
+        return
+    if retry_due or fingerprint != st.session_state.dropbox_fingerprint:
+        previous = st.session_state.data
+        st.session_state.data = load_documents(dbx, fingerprint)
+        # A failed load returns the current data unchanged
+        if st.session_state.data is not previous:
+            st.rerun(scope="app")
 
 
 _poll_dropbox()
 
 
-# --- AI Tools ---
+# --- AI ---
+MODEL = "claude-sonnet-4-20250514"
+SUMMARY_MODEL = "claude-3-5-haiku-20241022"
+HISTORY_WINDOW = 30  # most recent messages always sent verbatim
+HISTORY_ROLLUP_THRESHOLD = 60  # unsummarized messages before older ones are rolled up
+
 AI_TOOLS = [
     {
         "name": "update_report",
@@ -243,136 +419,224 @@ AI_TOOLS = [
 ]
 
 
+# Files changed by tool calls during the current AI turn; saved once it ends
+_dirty = set()
+
+
+def _update_report(params, now):
+    section_id = params["section_id"]
+    title = params["title"]
+    content = params["content"]
+    section = st.session_state.reports.get(section_id)
+    if section is not None:
+        if section["title"] == title and section["content"] == content:
+            # Model re-emitted the same section; nothing to save
+            return f"Report section '{title}' unchanged"
+        section["title"] = title
+        section["content"] = content
+        section["updated_at"] = now
+        _dirty.add("reports")
+        return f"Updated report section '{title}'"
+    st.session_state.reports[section_id] = {
+        "id": section_id,
+        "title": title,
+        "content": content,
+        "created_at": now,
+        "updated_at": now,
+    }
+    _dirty.add("reports")
+    return f"Created report section '{title}'"
+
+
+def _delete_report_section(params, now):
+    section_id = params["section_id"]
+    if st.session_state.reports.pop(section_id, None) is not None:
+        _dirty.add("reports")
+        return f"Deleted report section '{section_id}'"
+    return f"Section '{section_id}' not found"
+
+
+def _add_note(params, now):
+    st.session_state.notes.append({
+        "note": params["note"],
+        "added_at": now,
+    })
+    _dirty.add("notes")
+    return f"Saved note: '{params['note']}'"
+
+
+def _remove_note(params, now):
+    idx = params["note_index"]
+    if 0 <= idx < len(st.session_state.notes):
+        removed = st.session_state.notes.pop(idx)
+        _dirty.add("notes")
+        return f"Removed note: '{removed['note']}'"
+    return f"Invalid note index {idx}"
+
+
+def _save_interview_entry(params, now):
+    st.session_state.interview.append({
+        "topic": params["topic"],
+        "question": params["question"],
+        "answer": params["answer"],
+        "answered_at": now,
+    })
+    _dirty.add("interview")
+    return f"Saved interview entry under '{params['topic']}'"
+
+
+def _update_interview_entry(params, now):
+    idx = params["entry_index"]
+    if 0 <= idx < len(st.session_state.interview):
+        st.session_state.interview[idx]["answer"] = params["answer"]
+        st.session_state.interview[idx]["answered_at"] = now
+        _dirty.add("interview")
+        return f"Updated interview entry {idx}"
+    return f"Invalid entry index {idx}"
+
+
+TOOL_HANDLERS = {
+    "update_report": _update_report,
+    "delete_report_section": _delete_report_section,
+    "add_note": _add_note,
+    "remove_note": _remove_note,
+    "save_interview_entry": _save_interview_entry,
+    "update_interview_entry": _update_interview_entry,
+}
+
+
+def save_dirty():
+    """Save each file kind touched by tool calls once, then reset the dirty set."""
+    if _dirty:
+        st.session_state.state_version += 1
+    for key in _dirty:
+        {"reports": save_reports, "notes": save_notes, "interview": save_interview}[key]()
+    _dirty.clear()
+
+
 def handle_tool_call(name, params):
     """Execute a tool call and return a result string."""
-    if name == "update_report":
-        section_id = params["section_id"]
-        title = params["title"]
-        content = params["content"]
-        for section in st.session_state.reports:
-            if section["id"] == section_id:
-                section["title"] = title
-                section["content"] = content
-                section["updated_at"] = datetime.now().isoformat()
-                save_reports()
-                return f"Updated report section '{title}'"
-        st.session_state.reports.append({
-            "id": section_id,
-            "title": title,
-            "content": content,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-        })
-        save_reports()
-        return f"Created report section '{title}'"
-
-    if name == "delete_report_section":
-        section_id = params["section_id"]
-        before = len(st.session_state.reports)
-        st.session_state.reports = [
-            s for s in st.session_state.reports if s["id"] != section_id
-        ]
-        if len(st.session_state.reports) < before:
-            save_reports()
-            return f"Deleted report section '{section_id}'"
-        return f"Section '{section_id}' not found"
-
-    if name == "add_note":
-        st.session_state.notes.append({
-            "note": params["note"],
-            "added_at": datetime.now().isoformat(),
-        })
-        save_notes()
-        return f"Saved note: '{params['note']}'"
-
-    if name == "remove_note":
-        idx = params["note_index"]
-        if 0 <= idx < len(st.session_state.notes):
-            removed = st.session_state.notes.pop(idx)
-            save_notes()
-            return f"Removed note: '{removed['note']}'"
-        return f"Invalid note index {idx}"
-
-    if name == "save_interview_entry":
-        st.session_state.interview.append({
-            "topic": params["topic"],
-            "question": params["question"],
-            "answer": params["answer"],
-            "answered_at": datetime.now().isoformat(),
-        })
-        save_interview()
-        return f"Saved interview entry under '{params['topic']}'"
+    handler = TOOL_HANDLERS.get(name)
+    if handler is None:
+        return "Unknown tool"
+    return handler(params, datetime.now().isoformat())
 
-    if name == "update_interview_entry":
-        idx = params["entry_index"]
-        if 0 <= idx < len(st.session_state.interview):
-            st.session_state.interview[idx]["answer"] = params["answer"]
-            st.session_state.interview[idx]["answered_at"] = datetime.now().isoformat()
-            save_interview()
-            return f"Updated interview entry {idx}"
-        return f"Invalid entry index {idx}"
 
-    return "Unknown tool"
+@st.cache_resource(show_spinner=False)
+def _anthropic_client(api_key):
+    """Share one Anthropic client (and its keep-alive connection pool) across turns."""
+    return anthropic.Anthropic(api_key=api_key, max_retries=2, timeout=60.0)
 
 
-def send_to_ai(user_message):
-    """Send a message to the AI, handle tool use loop, save results."""
+def _stream_response(client, system, api_messages, placeholder=None):
+    """Stream one model response, rendering its text into placeholder as it arrives."""
+    with client.messages.stream(
+        model=MODEL,
+        max_tokens=4096,
+        system=system,
+        messages=api_messages,
+        tools=AI_TOOLS,
+    ) as stream:
+        if placeholder is not None:
+            text = ""
+            for chunk in stream.text_stream:
+                text += chunk
+                placeholder.markdown(text)
+        return stream.get_final_message()
+
+
+def roll_up_history(client):
+    """Fold older chat messages into a running summary so each turn sends a bounded history.
+
+    The full history is still kept and persisted; only the messages sent to
+    the API are trimmed to those after history_summary["upto"].
+    """
+    messages = st.session_state.messages
+    summary = st.session_state.history_summary
+    if len(messages) - summary["upto"] <= HISTORY_ROLLUP_THRESHOLD:
+        return
+
+    # The API expects the conversation to open with a user turn
+    upto = len(messages) - HISTORY_WINDOW
+    while upto < len(messages) and messages[upto]["role"] != "user":
+        upto += 1
+
+    transcript = "\n\n".join(
+        f"{m['role'].upper()}: {m['content']}" for m in messages[summary["upto"]:upto]
+    )
+    prompt = (
+        "Summarize this conversation between a family member and an inheritance advisor. "
+        "Keep every fact, figure, name, decision, and open question; drop pleasantries.\n\n"
+    )
+    if summary["text"]:
+        prompt += f"Summary of the conversation before this part:\n{summary['text']}\n\n"
+    prompt += f"Conversation:\n{transcript}"
+
     try:
-        api_key = st.secrets.get("ANTHROPIC_API_KEY", "") or os.environ.get("ANTHROPIC_API_KEY", "")
-    except Exception:
-        api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-    if not api_key:
+        response = client.messages.create(
+            model=SUMMARY_MODEL,
+            max_tokens=1024,
+            messages=[{"role": "user", "content": prompt}],
+        )
+    except anthropic.APIError as e:
+        logger.warning("History summary failed: %s", e)
+        return
+
+    text = "".join(block.text for block in response.content if block.type == "text")
+    if text:
+        st.session_state.history_summary = {"upto": upto, "text": text}
+        save_history_summary()
+
+
+def send_to_ai(user_message, placeholder=None):
+    """Send a message to the AI, handle tool use loop, save results.
+
+    If placeholder (an st.empty) is given, the reply is streamed into it.
+    """
+    if not ANTHROPIC_API_KEY:
         return None
 
     st.session_state.messages.append({"role": "user", "content": user_message})
 
+    client = _anthropic_client(ANTHROPIC_API_KEY)
+    roll_up_history(client)
+
     context = build_context(st.session_state.data)
     api_messages = [
         {"role": m["role"], "content": m["content"]}
-        for m in st.session_state.messages
+        for m in st.session_state.messages[st.session_state.history_summary["upto"]:]
     ]
 
-    client = anthropic.Anthropic(api_key=api_key)
-
-    response = client.messages.create(
-        model="claude-sonnet-4-20250514",
-        max_tokens=4096,
-        system=context,
-        messages=api_messages,
-        tools=AI_TOOLS,
-    )
+    try:
+        response = _stream_response(client, context, api_messages, placeholder)
+
+        # Tool use loop
+        while response.stop_reason == "tool_use":
+            assistant_content = []
+            tool_results = []
+            for block in response.content:
+                if block.type == "text":
+                    assistant_content.append({"type": "text", "text": block.text})
+                elif block.type == "tool_use":
+                    assistant_content.append({
+                        "type": "tool_use",
+                        "id": block.id,
+                        "name": block.name,
+                        "input": block.input,
+                    })
+                    result = handle_tool_call(block.name, block.input)
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": block.id,
+                        "content": result,
+                    })
 
-    # Tool use loop
-    while response.stop_reason == "tool_use":
-        assistant_content = []
-        tool_results = []
-        for block in response.content:
-            if block.type == "text":
-                assistant_content.append({"type": "text", "text": block.text})
-            elif block.type == "tool_use":
-                assistant_content.append({
-                    "type": "tool_use",
-                    "id": block.id,
-                    "name": block.name,
-                    "input": block.input,
-                })
-                result = handle_tool_call(block.name, block.input)
-                tool_results.append({
-                    "type": "tool_result",
-                    "tool_use_id": block.id,
-                    "content": result,
-                })
-
-        api_messages.append({"role": "assistant", "content": assistant_content})
-        api_messages.append({"role": "user", "content": tool_results})
+            api_messages.append({"role": "assistant", "content": assistant_content})
+            api_messages.append({"role": "user", "content": tool_results})
 
-        response = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4096,
-            system=context,
-            messages=api_messages,
-            tools=AI_TOOLS,
-        )
+            response = _stream_response(client, context, api_messages, placeholder)
+    finally:
+        save_dirty()
 
     # Extract final text reply
     reply = ""
@@ -381,6 +645,9 @@ def send_to_ai(user_message):
             reply += block.text
     reply = reply or "Done \u2014 check the Report panel."
 
+    if placeholder is not None:
+        placeholder.markdown(reply)
+
     st.session_state.messages.append({"role": "assistant", "content": reply})
     save_chat_history()
     return reply
@@ -397,94 +664,195 @@ TOPIC_LABELS = {
 }
 
 
-def build_context(data):
-    """Build document context string for the AI."""
-    parts = [
-        "You are an advisor helping an Italian family with inheritance division.",
-        "You have access to the following documents and extracted data.",
-        "Answer in the same language the user writes in (Italian or English).",
-        "When discussing legal matters, note that this is informational only, not legal advice.",
-        "",
-        "== YOUR TOOLS ==",
-        "",
-        "REPORTS: You can create/update/delete report sections on the Report panel using",
-        "update_report and delete_report_section. Use these when asked to create reports,",
-        "summaries, proposals, or any structured output.",
-        "",
-        "NOTES: When the user corrects information or provides new facts, ALWAYS use add_note",
-        "to save it. Notes override document data and persist across sessions.",
-        "",
-        "INTERVIEW: When conducting an interview, save each answer using save_interview_entry.",
-        "If the user corrects a previous interview answer, use update_interview_entry.",
-        "Interview data is the DEFINITIVE source of truth \u2014 it takes highest priority",
-        "over documents and notes when generating reports or answering questions.",
-        "",
-        "When conducting an interview, ask ONE question at a time. Cover these topics:",
-        "- Deceased: name, date of death, place of residence, marital status at death",
-        "- Family: complete family tree, spouse(s), all children and their families",
-        "- Properties: all real estate, locations, estimated values, ownership details",
-        "- Finances: bank accounts, investments, pensions, debts, mortgages",
-        "- Legal: existing wills, donations, prior agreements, power of attorney",
-        "- Agreements: any informal agreements between heirs, preferences, disputes",
-        "Review what has already been answered before asking the next question.",
-        "Ask follow-up questions when answers are incomplete or raise new topics.",
-        "",
-    ]
+def interview_by_topic():
+    """Group interview entry indices by topic, regrouping only when entries are added.
 
-    # Interview data (highest priority)
-    if st.session_state.interview:
-        parts.append("== INTERVIEW DATA (definitive source of truth) ==")
+    Entries are only ever appended and never change topic, so the list
+    identity and length are enough to tell whether the grouping is stale.
+    """
+    interview = st.session_state.interview
+    key = (id(interview), len(interview))
+    cached = st.session_state.get("interview_topics")
+    if cached is None or cached[0] != key:
         topics = {}
-        for i, entry in enumerate(st.session_state.interview):
-            topics.setdefault(entry["topic"], []).append((i, entry))
-        for topic, entries in topics.items():
-            label = TOPIC_LABELS.get(topic, topic.title())
-            parts.append(f"\n--- {label} ---")
-            for i, entry in entries:
-                parts.append(f"  [{i}] Q: {entry['question']}")
-                parts.append(f"      A: {entry['answer']}")
-        parts.append("")
+        for i, entry in enumerate(interview):
+            topics.setdefault(entry["topic"], []).append(i)
+        cached = (key, topics)
+        st.session_state.interview_topics = cached
+    return cached[1]
 
-    # Notes (override documents)
-    if st.session_state.notes:
-        parts.append("== CORRECTIONS & NOTES (override document data) ==")
-        for i, n in enumerate(st.session_state.notes):
-            parts.append(f"  {i}. {n['note']} (added {n['added_at'][:10]})")
-        parts.append("")
+
+def build_context(data):
+    """Build the system prompt blocks for the AI.
+
+    The document prefix only changes with the Dropbox contents, so it is
+    memoized and marked for Anthropic prompt caching; the small state suffix
+    (interview, notes, reports) is rebuilt on every turn.
+    """
+    blocks = [{
+        "type": "text",
+        "text": _build_docs_prefix(
+            st.session_state.dropbox_fingerprint, data["scan_date"], data
+        ),
+        "cache_control": {"type": "ephemeral"},
+    }]
+    suffix = _build_state_suffix(
+        st.session_state.interview,
+        interview_by_topic(),
+        st.session_state.notes,
+        st.session_state.reports,
+        st.session_state.history_summary["text"],
+    )
+    if suffix:
+        blocks.append({"type": "text", "text": suffix})
+    return blocks
+
+
+CONTEXT_TEXT_BUDGET = 400_000  # characters of raw document text sent in full (~100k tokens)
+DOC_EXCERPT_CHARS = 2_000  # leading characters sent for documents past the budget
+
+CONTEXT_INSTRUCTIONS = """\
+You are an advisor helping an Italian family with inheritance division.
+You have access to the following documents and extracted data.
+Answer in the same language the user writes in (Italian or English).
+When discussing legal matters, note that this is informational only, not legal advice.
+
+== YOUR TOOLS ==
+
+REPORTS: You can create/update/delete report sections on the Report panel using
+update_report and delete_report_section. Use these when asked to create reports,
+summaries, proposals, or any structured output.
+
+NOTES: When the user corrects information or provides new facts, ALWAYS use add_note
+to save it. Notes override document data and persist across sessions.
+
+INTERVIEW: When conducting an interview, save each answer using save_interview_entry.
+If the user corrects a previous interview answer, use update_interview_entry.
+Interview data is the DEFINITIVE source of truth \u2014 it takes highest priority
+over documents and notes when generating reports or answering questions.
+
+When conducting an interview, ask ONE question at a time. Cover these topics:
+- Deceased: name, date of death, place of residence, marital status at death
+- Family: complete family tree, spouse(s), all children and their families
+- Properties: all real estate, locations, estimated values, ownership details
+- Finances: bank accounts, investments, pensions, debts, mortgages
+- Legal: existing wills, donations, prior agreements, power of attorney
+- Agreements: any informal agreements between heirs, preferences, disputes
+Review what has already been answered before asking the next question.
+Ask follow-up questions when answers are incomplete or raise new topics.
+
+"""
+
+
+# cache_resource hands back the same str object instead of unpickling a copy
+# of the (potentially multi-MB) prefix on every hit; strings are immutable.
+@st.cache_resource(max_entries=4, show_spinner=False)
+def _build_docs_prefix(fingerprint, scan_date, _data):
+    """Instructions plus document data; `_data` is keyed by fingerprint and scan date, not hashed."""
+    data = _data
+    buf = io.StringIO()
+    w = buf.write
+    w(CONTEXT_INSTRUCTIONS)
 
     # Document data
     if data["heirs"]:
-        parts.append("== HEIRS (Eredi) \u2014 from documents ==")
+        w("== HEIRS (Eredi) \u2014 from documents ==\n")
         for i, h in enumerate(data["heirs"], 1):
-            line = f"  {i}. {h.get('name', 'Unknown')}"
+            w(f"  {i}. {h.get('name', 'Unknown')}")
             if h.get("date_of_birth"):
-                line += f", born {h['date_of_birth']}"
+                w(f", born {h['date_of_birth']}")
             if h.get("marital_status"):
-                line += f", {h['marital_status']}"
+                w(f", {h['marital_status']}")
             if h.get("num_children") is not None:
-                line += f", {h['num_children']} children"
-            parts.append(line)
-        parts.append("")
+                w(f", {h['num_children']} children")
+            w("\n")
+        w("\n")
 
     if data["assets"]:
-        parts.append("== ASSETS (Immobili / Beni) \u2014 from documents ==")
+        w("== ASSETS (Immobili / Beni) \u2014 from documents ==\n")
         for i, a in enumerate(data["assets"], 1):
-            parts.append(f"  {i}. {a['description']}")
-        parts.append("")
+            w(f"  {i}. {a['description']}\n")
+        w("\n")
 
-    parts.append("== RAW DOCUMENT TEXT ==")
+    w("== RAW DOCUMENT TEXT ==\n")
+    used = 0
     for doc in data["documents"]:
-        parts.append(f"\n--- Document: {doc['path']} (from folder: {doc['folder']}) ---")
-        parts.append(doc["text"])
+        w(f"\n--- Document: {doc['path']} (from folder: {doc['folder']}) ---\n")
+        text = doc["text"]
+        if used + len(text) <= CONTEXT_TEXT_BUDGET or len(text) <= DOC_EXCERPT_CHARS:
+            w(text)
+            used += len(text)
+        else:
+            # Over budget: send the opening of the document only
+            w(text[:DOC_EXCERPT_CHARS])
+            w(f"\n[... truncated, {len(text) - DOC_EXCERPT_CHARS} more characters not shown ...]")
+            used += DOC_EXCERPT_CHARS
+        w("\n")
+
+    return buf.getvalue()
+
+
+def _build_state_suffix(interview, topics, notes, reports, history_summary):
+    """Interview answers, notes, report sections, and earlier-chat summary."""
+    buf = io.StringIO()
+    w = buf.write
+
+    # Interview data (highest priority)
+    if interview:
+        w("== INTERVIEW DATA (definitive source of truth) ==\n")
+        for topic, indices in topics.items():
+            w(f"\n--- {TOPIC_LABELS.get(topic, topic.title())} ---\n")
+            for i in indices:
+                entry = interview[i]
+                w(f"  [{i}] Q: {entry['question']}\n")
+                w(f"      A: {entry['answer']}\n")
+        w("\n")
+
+    # Notes (override documents)
+    if notes:
+        w("== CORRECTIONS & NOTES (override document data) ==\n")
+        for i, n in enumerate(notes):
+            w(f"  {i}. {n['note']} (added {n['added_at'][:10]})\n")
+        w("\n")
 
     # Current report sections
-    if st.session_state.reports:
-        parts.append("\n== CURRENT REPORT SECTIONS ==")
-        for s in st.session_state.reports:
-            parts.append(f"\n--- Section: {s['title']} (id: {s['id']}) ---")
-            parts.append(s["content"])
+    if reports:
+        w("\n== CURRENT REPORT SECTIONS ==\n")
+        for s in reports.values():
+            w(f"\n--- Section: {s['title']} (id: {s['id']}) ---\n")
+            w(s["content"])
+            w("\n")
+
+    # Older chat turns no longer sent verbatim
+    if history_summary:
+        w("\n== EARLIER CONVERSATION (summary) ==\n")
+        w(history_summary)
+        w("\n")
+
+    return buf.getvalue()
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def _heir_tables(fingerprint, scan_date, _heirs):
+    """Heirs table rows and {dob: names} for shared birth dates, computed once per scan."""
+    heir_rows = []
+    for i, h in enumerate(_heirs, 1):
+        heir_rows.append({
+            "#": i,
+            "Name": h.get("name", "Unknown"),
+            "Date of Birth": h.get("date_of_birth", ""),
+            "Marital Status": h.get("marital_status", ""),
+            "Children": h.get("num_children", ""),
+        })
 
-    return "\n".join(parts)
+    # Count first; names are only collected for the (usually absent) shared dates
+    dob_counts = Counter(h["date_of_birth"] for h in _heirs if h.get("date_of_birth"))
+    twin_dobs = {dob for dob, count in dob_counts.items() if count > 1}
+    twins = {}
+    for h in _heirs:
+        if h.get("date_of_birth") in twin_dobs:
+            twins.setdefault(h["date_of_birth"], []).append(h["name"])
+    return heir_rows, twins
 
 
 # --- Sidebar ---
@@ -509,44 +877,15 @@ with st.sidebar:
 
 
 # --- Custom CSS for layout ---
-st.markdown("""
-<style>
-/* Make columns stick independently with separate scrolling */
-[data-testid="column"] {
-    overflow-y: auto;
-    max-height: calc(100vh - 100px);
-    padding-right: 1rem;
-}
+@st.cache_resource(show_spinner=False)
+def _load_css():
+    with open("assets/styles.css", encoding="utf-8") as f:
+        return f"<style>\n{f.read()}</style>"
 
-/* Blue highlighted expandable report items */
-div[data-testid="stExpander"] details {
-    border: 1px solid #1976D2;
-    border-radius: 8px;
-    margin-bottom: 0.5rem;
-}
-div[data-testid="stExpander"] details summary {
-    background-color: #E3F2FD;
-    color: #1565C0;
-    font-weight: 600;
-    border-radius: 8px;
-    padding: 0.6rem 1rem;
-}
-div[data-testid="stExpander"] details[open] summary {
-    border-radius: 8px 8px 0 0;
-}
 
-/* Green interview button */
-.interview-btn button {
-    background-color: #2E7D32 !important;
-    color: white !important;
-    border: none !important;
-}
-.interview-btn button:hover {
-    background-color: #1B5E20 !important;
-    color: white !important;
-}
-</style>
-""", unsafe_allow_html=True)
+# Streamlit drops elements a rerun doesn't re-emit, so the <style> tag is
+# written every run; only the file read is cached.
+st.markdown(_load_css(), unsafe_allow_html=True)
 
 # --- Main Layout: Report (2/3) | Chat (1/3) ---
 col_report, col_chat = st.columns([2, 1])
@@ -563,25 +902,12 @@ with col_report:
         # Heirs
         with st.expander("Heirs (Eredi)", expanded=False):
             if data["heirs"]:
-                heir_rows = []
-                for i, h in enumerate(data["heirs"], 1):
-                    heir_rows.append({
-                        "#": i,
-                        "Name": h.get("name", "Unknown"),
-                        "Date of Birth": h.get("date_of_birth", ""),
-                        "Marital Status": h.get("marital_status", ""),
-                        "Children": h.get("num_children", ""),
-                    })
+                heir_rows, twins = _heir_tables(
+                    st.session_state.dropbox_fingerprint, data["scan_date"], data["heirs"]
+                )
                 st.table(heir_rows)
-
-                dobs = {}
-                for h in data["heirs"]:
-                    dob = h.get("date_of_birth", "")
-                    if dob:
-                        dobs.setdefault(dob, []).append(h["name"])
-                for dob, names in dobs.items():
-                    if len(names) > 1:
-                        st.info(f"\U0001f46f {', '.join(names)} share DOB {dob} (twins)")
+                for dob, names in twins.items():
+                    st.info(f"\U0001f46f {', '.join(names)} share DOB {dob} (twins)")
             else:
                 st.warning("No heirs found yet.")
 
@@ -622,16 +948,13 @@ with col_report:
                 f"Interview Data ({len(st.session_state.interview)} entries)",
                 expanded=False,
             ):
-                topics = {}
-                for i, entry in enumerate(st.session_state.interview):
-                    topics.setdefault(entry["topic"], []).append((i, entry))
-
                 with st.form("interview_edit"):
                     edited_answers = {}
-                    for topic, entries in topics.items():
+                    for topic, indices in interview_by_topic().items():
                         label = TOPIC_LABELS.get(topic, topic.title())
                         st.markdown(f"**{label}**")
-                        for i, entry in entries:
+                        for i in indices:
+                            entry = st.session_state.interview[i]
                             st.caption(entry["question"])
                             edited_answers[i] = st.text_area(
                                 f"answer_{i}",
@@ -667,7 +990,7 @@ with col_report:
         if st.session_state.reports:
             st.divider()
             st.subheader("AI Reports")
-            for section in st.session_state.reports:
+            for section in st.session_state.reports.values():
                 with st.expander(section["title"], expanded=False):
                     st.markdown(section["content"])
                     st.caption(
@@ -675,56 +998,77 @@ with col_report:
                     )
 
 # --- Chat Column (scrollable independently) ---
+CHAT_PAGE_SIZE = 50  # messages rendered per "Load earlier" step
+
+
+@st.fragment
+def _chat_panel():
+    """Chat history, input, and interview button; reruns on its own when used."""
+    if st.session_state.chat_save_disabled:
+        st.warning("Chat history couldn't be loaded from Dropbox, so this session's chat won't be saved.")
+
+    # Green Interview button at top of chat
+    interview_label = "Interview"
+    if st.session_state.interview:
+        interview_label = f"Interview ({len(st.session_state.interview)})"
+
+    st.markdown('<div class="interview-btn">', unsafe_allow_html=True)
+    interview_clicked = st.button(interview_label, use_container_width=True)
+    st.markdown('</div>', unsafe_allow_html=True)
+
+    # Scrollable chat history
+    chat_container = st.container(height=500)
+    with chat_container:
+        # Only render the most recent messages; older ones load on demand
+        hidden = len(st.session_state.messages) - st.session_state.chat_visible
+        if hidden > 0 and st.button(f"Load earlier ({hidden} more)", key="load_earlier"):
+            st.session_state.chat_visible += CHAT_PAGE_SIZE
+            st.rerun(scope="fragment")
+        for msg in st.session_state.messages[-st.session_state.chat_visible:]:
+            with st.chat_message(msg["role"]):
+                st.markdown(msg["content"])
+
+    # Chat input
+    prompt = st.chat_input("Ask about the inheritance...")
+    if interview_clicked:
+        if not st.session_state.interview:
+            prompt = (
+                "Please start the interview. Ask me ONE question at a time to gather "
+                "information about the inheritance situation. Start with the basics."
+            )
+        else:
+            prompt = (
+                "Please continue the interview. Review what has already been covered "
+                "and ask the next most useful question. Ask ONE question at a time."
+            )
+
+    if prompt:
+        # Show the new message and stream the reply into the history
+        with chat_container:
+            with st.chat_message("user"):
+                st.markdown(prompt)
+            with st.chat_message("assistant"):
+                placeholder = st.empty()
+        version = st.session_state.state_version
+        with st.spinner("Thinking..."):
+            send_to_ai(prompt, placeholder)
+        # The reply is already on screen; only redraw the report side if a
+        # tool call changed reports, notes, or the interview
+        if st.session_state.state_version != version:
+            st.rerun(scope="app")
+
+    # Disclaimer
+    st.caption(
+        "\u26a0\ufe0f Informational only \u2014 not legal advice."
+    )
+
+
 with col_chat:
     st.header("Chat")
 
     if st.session_state.data is None:
         st.info("Waiting for documents to load from Dropbox...")
+    elif not ANTHROPIC_API_KEY:
+        st.error("AI chat not configured.")
     else:
-        try:
-            api_key = st.secrets.get("ANTHROPIC_API_KEY", "") or os.environ.get("ANTHROPIC_API_KEY", "")
-        except Exception:
-            api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-
-        if not api_key:
-            st.error("AI chat not configured.")
-        else:
-            # Green Interview button at top of chat
-            interview_label = "Interview"
-            if st.session_state.interview:
-                interview_label = f"Interview ({len(st.session_state.interview)})"
-
-            st.markdown('<div class="interview-btn">', unsafe_allow_html=True)
-            if st.button(interview_label, use_container_width=True):
-                if not st.session_state.interview:
-                    trigger = (
-                        "Please start the interview. Ask me ONE question at a time to gather "
-                        "information about the inheritance situation. Start with the basics."
-                    )
-                else:
-                    trigger = (
-                        "Please continue the interview. Review what has already been covered "
-                        "and ask the next most useful question. Ask ONE question at a time."
-                    )
-                with st.spinner("Thinking..."):
-                    send_to_ai(trigger)
-                st.rerun()
-            st.markdown('</div>', unsafe_allow_html=True)
-
-            # Scrollable chat history
-            chat_container = st.container(height=500)
-            with chat_container:
-                for msg in st.session_state.messages:
-                    with st.chat_message(msg["role"]):
-                        st.markdown(msg["content"])
-
-            # Chat input
-            if prompt := st.chat_input("Ask about the inheritance..."):
-                with st.spinner("Thinking..."):
-                    send_to_ai(prompt)
-                st.rerun()
-
-            # Disclaimer
-            st.caption(
-                "\u26a0\ufe0f Informational only \u2014 not legal advice."
-            )
+        _chat_panel()
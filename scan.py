@@ -5,31 +5,155 @@ Reads documents from Dropbox API (App folder), extracts text,
 parses structured data (heirs, assets, valuations), and generates reports.
 """
 
+import atexit
+import functools
+import gzip
 import io
 import json
+import logging
 import os
+import queue
 import re
 import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 import dropbox
 
-# File type handlers — all take a file path and return text
-def read_txt(path):
-    encodings = ['utf-8', 'latin-1', 'cp1252']
-    for enc in encodings:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Heavy parser modules are imported on first use, then reused
+@functools.cache
+def _pdfplumber():
+    import pdfplumber
+    return pdfplumber
+
+@functools.cache
+def _pypdfium2():
+    import pypdfium2
+    return pypdfium2
+
+@functools.cache
+def _docx_document():
+    from docx import Document
+    return Document
+
+@functools.cache
+def _load_workbook():
+    from openpyxl import load_workbook
+    return load_workbook
+
+@functools.cache
+def _pytesseract():
+    import pytesseract
+    return pytesseract
+
+@functools.cache
+def _tesserocr():
+    import tesserocr
+    return tesserocr
+
+# PyTessBaseAPI is not thread-safe, so each OCR call borrows an idle handle;
+# at most one handle per core exists, each keeping its language model loaded
+_tesserocr_apis = queue.SimpleQueue()
+_tesserocr_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+@functools.cache
+def _pil_image():
+    from PIL import Image
+    return Image
+
+# File type handlers — all take the file's bytes and return text
+def read_txt(data):
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    # Legacy Italian text is almost always Windows-1252; latin-1 maps every
+    # byte, so it catches the few that cp1252 leaves undefined
+    try:
+        return data.decode('cp1252')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+PDF_OCR_MIN_CHARS = 20  # pages with less extractable text than this are treated as scans
+PDF_OCR_SCALE = 200 / 72  # render scanned pages at 200 dpi for OCR
+
+# PDFium is not thread-safe, not even across separate documents, so every
+# pypdfium2 call (open, text, render, close) runs under this lock
+_pdfium_lock = threading.Lock()
+
+def _pdfium_page(pdf, index, ocr):
+    """Return (text, image) for one page; image is a render to OCR, or None.
+
+    The caller holds _pdfium_lock. Page objects are closed explicitly so no
+    PDFium call is left to a garbage-collector finalizer on another thread.
+    """
+    page = pdf[index]
+    try:
+        textpage = page.get_textpage()
         try:
-            return Path(path).read_text(encoding=enc)
-        except (UnicodeDecodeError, Exception):
-            continue
-    return None
+            t = textpage.get_text_range().replace('\r\n', '\n')
+        finally:
+            textpage.close()
+        img = None
+        if ocr and len(t.strip()) < PDF_OCR_MIN_CHARS:
+            # Scanned page: rasterize in memory for OCR
+            try:
+                bitmap = page.render(scale=PDF_OCR_SCALE)
+                try:
+                    img = bitmap.to_pil().copy()  # own the pixels; the bitmap is freed below
+                finally:
+                    bitmap.close()
+            except Exception:
+                img = None
+        return t, img
+    finally:
+        page.close()
+
+def _read_pdf_pdfium(data):
+    ocr = _ocr_available()  # probe outside the lock; it may load a Tesseract model
+    with _pdfium_lock:
+        pdf = _pypdfium2().PdfDocument(data)
+    try:
+        with _pdfium_lock:
+            n_pages = len(pdf)
+        text = []
+        for index in range(n_pages):
+            with _pdfium_lock:
+                t, img = _pdfium_page(pdf, index, ocr)
+            if img is not None:
+                # OCR runs outside the lock so other threads can use PDFium meanwhile
+                try:
+                    t = _ocr(img) or t
+                except Exception:
+                    pass
+            if t.strip():
+                text.append(t)
+        return '\n\n'.join(text) if text else None
+    finally:
+        with _pdfium_lock:
+            pdf.close()
 
-def read_pdf(path):
+def read_pdf(data):
+    # PDFium extracts plain text far faster than pdfplumber's layout engine;
+    # pdfplumber remains the fallback when pypdfium2 is missing or fails
+    try:
+        return _read_pdf_pdfium(data)
+    except Exception:
+        pass
     try:
-        import pdfplumber
         text = []
-        with pdfplumber.open(path) as pdf:
+        with _pdfplumber().open(io.BytesIO(data)) as pdf:
             for page in pdf.pages:
                 t = page.extract_text()
                 if t:
@@ -38,45 +162,69 @@ def read_pdf(path):
     except Exception as e:
         return None
 
-def read_docx(path):
+def read_docx(data):
     try:
-        from docx import Document
-        doc = Document(path)
+        doc = _docx_document()(io.BytesIO(data))
         return '\n'.join(p.text for p in doc.paragraphs if p.text.strip())
     except Exception as e:
         return None
 
-def read_xlsx(path):
+def read_xlsx(data):
     try:
-        from openpyxl import load_workbook
-        wb = load_workbook(path, read_only=True, data_only=True)
+        wb = _load_workbook()(io.BytesIO(data), read_only=True, data_only=True)
         text = []
         for sheet in wb.sheetnames:
             ws = wb[sheet]
             text.append(f"--- Sheet: {sheet} ---")
             for row in ws.iter_rows(values_only=True):
-                cells = [str(c) if c is not None else '' for c in row]
-                if any(cells):
-                    text.append('\t'.join(cells))
+                # Skip blank rows before stringifying; 0 and False still count as content
+                if all(c is None or c == '' for c in row):
+                    continue
+                text.append('\t'.join('' if c is None else str(c) for c in row))
         return '\n'.join(text) if text else None
     except Exception as e:
         return None
 
-def read_csv(path):
+def read_csv(data):
+    # Windows-exported CSVs need the same cp1252 fallback as text files
+    return read_txt(data)
+
+def _ocr_tesserocr(img):
+    with _tesserocr_slots:
+        try:
+            api = _tesserocr_apis.get_nowait()
+        except queue.Empty:
+            api = _tesserocr().PyTessBaseAPI(lang='ita+eng')
+        try:
+            api.SetImage(img)
+            return api.GetUTF8Text()
+        finally:
+            _tesserocr_apis.put(api)
+
+@functools.cache
+def _ocr_available():
+    """True if tesserocr or pytesseract's tesseract binary can OCR; checked once per process."""
     try:
-        return Path(path).read_text(encoding='utf-8')
+        # Keep the probe handle: it is the first one OCR calls will borrow
+        _tesserocr_apis.put(_tesserocr().PyTessBaseAPI(lang='ita+eng'))
+        return True
     except Exception:
-        try:
-            return Path(path).read_text(encoding='latin-1')
-        except Exception:
-            return None
+        pass
+    try:
+        _pytesseract().get_tesseract_version()
+        return True
+    except Exception:
+        return False
+
+def _ocr(img):
+    try:
+        return _ocr_tesserocr(img)
+    except Exception:
+        return _pytesseract().image_to_string(img, lang='ita+eng')
 
-def read_image(path):
+def read_image(data):
     try:
-        import pytesseract
-        from PIL import Image
-        img = Image.open(path)
-        text = pytesseract.image_to_string(img, lang='ita+eng')
+        text = _ocr(_pil_image().open(io.BytesIO(data)))
         return text if text.strip() else None
     except Exception:
         return None
@@ -107,78 +255,280 @@ def _get_secret(key):
         return os.environ.get(key, "")
 
 
-def get_dropbox_client():
+def get_dropbox_credentials():
+    """Return (refresh_token, app_key, app_secret, legacy_token) from secrets."""
+    return (
+        _get_secret("DROPBOX_REFRESH_TOKEN"),
+        _get_secret("DROPBOX_APP_KEY"),
+        _get_secret("DROPBOX_APP_SECRET"),
+        _get_secret("DROPBOX_TOKEN"),
+    )
+
+
+SCAN_WORKERS = 16  # concurrent downloads; well under Dropbox's rate limits
+# The SDK's default pool keeps 8 connections, so a full scan would open and
+# discard connections past that; the extra two cover the longpoll and the
+# app data writer sharing the client.
+DROPBOX_CONNECTIONS = SCAN_WORKERS + 2
+
+
+def get_dropbox_client(credentials=None):
     """Create Dropbox client using refresh token (preferred) or legacy access token."""
-    refresh_token = _get_secret("DROPBOX_REFRESH_TOKEN")
-    app_key = _get_secret("DROPBOX_APP_KEY")
-    app_secret = _get_secret("DROPBOX_APP_SECRET")
+    refresh_token, app_key, app_secret, token = credentials or get_dropbox_credentials()
+    session = dropbox.create_session(max_connections=DROPBOX_CONNECTIONS)
 
     if refresh_token and app_key and app_secret:
         return dropbox.Dropbox(
             oauth2_refresh_token=refresh_token,
             app_key=app_key,
             app_secret=app_secret,
+            session=session,
         )
 
     # Fallback to legacy short-lived token
-    token = _get_secret("DROPBOX_TOKEN")
     if token:
-        return dropbox.Dropbox(token)
+        return dropbox.Dropbox(token, session=session)
 
     return None
 
 
-def scan_dropbox(dbx, folder_path=""):
-    """Recursively scan Dropbox folder and extract text from all supported documents."""
+def is_document(entry):
+    """True for Dropbox file metadata that scan_dropbox extracts text from."""
+    return (
+        isinstance(entry, dropbox.files.FileMetadata)
+        and Path(entry.name).suffix.lower() in HANDLERS
+    )
+
+
+def _affects_documents(entry):
+    """True if a list_folder delta entry may add, change, or remove a document."""
+    # A deleted folder is reported as a single entry, so count every deletion
+    return isinstance(entry, dropbox.files.DeletedMetadata) or is_document(entry)
+
+
+def scan_dropbox(dbx, folder_path="", prior_docs=None, strict=False):
+    """Recursively scan Dropbox folder and extract text from all supported documents.
+
+    prior_docs maps document path to a document dict from an earlier scan;
+    entries whose content hash is unchanged reuse that dict as is.
+
+    Failures to list the folder or download a file are logged and skipped,
+    or with strict=True raised, so callers that cache the result never keep
+    a partial scan.
+    """
+    prior_docs = prior_docs or {}
+    scanned_at = datetime.now().isoformat()
     documents = []
 
     try:
         result = dbx.files_list_folder(folder_path, recursive=True)
     except Exception as e:
-        print(f"Error listing Dropbox folder: {e}")
+        if strict:
+            raise
+        logger.warning("Error listing Dropbox folder: %s", e)
         return documents
 
-    entries = list(result.entries)
+    pages = _list_pages(dbx, result)
+    archive = None
+    if not prior_docs and not any(DOC_CACHE_DIR.glob(f"{EXTRACT_VERSION}-*.json")):
+        # Cold scan: every document needs downloading. List everything first
+        # to decide whether one zip of the folder beats a request per file
+        entries = [entry for page in pages for entry in page]
+        pages = [entries]
+        if _zip_worthwhile(entries):
+            archive = _download_zip(dbx, folder_path)
+
+    # Otherwise each page's documents are submitted as it arrives, so
+    # downloads overlap the remaining listing round trips; futures keep
+    # listing order
+    listed = []
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+            for page in pages:
+                listed.extend(page)
+                futures.extend(
+                    pool.submit(
+                        _scan_entry, dbx, prior_docs, entry, folder_path, archive, scanned_at, strict
+                    )
+                    for entry in page if is_document(entry)
+                )
+            documents = [doc for doc in (f.result() for f in futures) if doc]
+    finally:
+        if archive:
+            _close_archive(archive)
+
+    if not folder_path:
+        # Only a scan of the whole Dropbox knows which cached files are stale
+        _prune_text_cache(listed)
+    return documents
+
+
+def _list_pages(dbx, result):
+    """Yield the entries of each list_folder page, fetching the next page on demand."""
+    yield result.entries
     while result.has_more:
         result = dbx.files_list_folder_continue(result.cursor)
-        entries.extend(result.entries)
+        yield result.entries
+
+
+DOC_CACHE_DIR = Path(__file__).resolve().parent / ".doc_cache"
+# Bump whenever a handler's output changes, so text extracted by the old
+# code is re-extracted instead of served from the cache
+EXTRACT_VERSION = 2
+
+
+def _cache_path(content_hash):
+    return DOC_CACHE_DIR / f"{EXTRACT_VERSION}-{content_hash}.json"
+
+
+def _read_cached_text(content_hash):
+    """Return text previously extracted from a file with this Dropbox content hash."""
+    try:
+        return _decode_app_data(_cache_path(content_hash).read_bytes())["text"]
+    except Exception:
+        return None
+
+
+def _write_cached_text(content_hash, text):
+    try:
+        DOC_CACHE_DIR.mkdir(exist_ok=True)
+        # Write then rename so a concurrent reader never sees a partial file
+        with tempfile.NamedTemporaryFile(dir=DOC_CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+            tmp.write(_encode_app_data({"text": text}))
+        os.replace(tmp.name, _cache_path(content_hash))
+    except OSError as e:
+        logger.warning("Error caching text for %s: %s", content_hash, e)
+
+
+def _prune_text_cache(entries):
+    """Delete cached text for files no longer in Dropbox or from an older EXTRACT_VERSION."""
+    keep = {
+        _cache_path(entry.content_hash).name
+        for entry in entries if is_document(entry) and entry.content_hash
+    }
+    for path in DOC_CACHE_DIR.glob("*.json"):
+        if path.name not in keep:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def _scan_entry(dbx, prior_docs, entry, folder_path, archive, scanned_at, strict):
+    return _reuse_document(prior_docs, entry) or _fetch_document(
+        dbx, entry, folder_path, archive, scanned_at, strict
+    )
+
+
+ZIP_MIN_DOCUMENTS = 20  # fewer documents download quickly enough one by one
+ZIP_MAX_ENTRIES = 10_000  # Dropbox's limit for files_download_zip
+ZIP_MAX_BYTES = 2 * 1024 ** 3  # bounds the temp file a cold scan writes
+
 
+def _zip_worthwhile(entries):
+    """True if zipping the folder mostly downloads documents, not other files.
+
+    The zip holds everything under the folder, including unsupported files
+    and _app_data, so it only pays off when documents dominate its size.
+    """
     files = [e for e in entries if isinstance(e, dropbox.files.FileMetadata)]
-    supported = [f for f in files if Path(f.name).suffix.lower() in HANDLERS]
+    documents = [e for e in files if is_document(e)]
+    document_bytes = sum(e.size for e in documents)
+    other_bytes = sum(e.size for e in files) - document_bytes
+    return (
+        len(documents) >= ZIP_MIN_DOCUMENTS
+        and len(entries) <= ZIP_MAX_ENTRIES
+        and document_bytes >= other_bytes
+        and document_bytes + other_bytes <= ZIP_MAX_BYTES
+    )
 
-    if not supported:
-        return documents
 
-    for entry in supported:
-        ext = Path(entry.name).suffix.lower()
-        handler = HANDLERS.get(ext)
-        rel_path = entry.path_display.lstrip('/')
-        folder = str(Path(rel_path).parent) if str(Path(rel_path).parent) != '.' else 'root'
+def _download_zip(dbx, folder_path):
+    """Download folder_path as a zip into a temp file; returns (ZipFile, members) or None.
 
-        # Download to temp file
-        try:
-            _, response = dbx.files_download(entry.path_lower)
-            with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as tmp:
-                tmp.write(response.content)
-                tmp_path = tmp.name
-
-            text = handler(tmp_path)
-            os.unlink(tmp_path)
-
-            if text and text.strip():
-                documents.append({
-                    'path': rel_path,
-                    'folder': folder,
-                    'filename': entry.name,
-                    'type': ext,
-                    'text': text.strip(),
-                    'scanned_at': datetime.now().isoformat(),
-                    'size_bytes': entry.size,
-                })
-        except Exception as e:
-            print(f"  Error processing {entry.name}: {e}")
+    members maps each file's path_lower relative to folder_path to its zip
+    member name. On failure callers fall back to downloading files one by
+    one. Release the archive with _close_archive.
+    """
+    fd, zip_path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        dbx.files_download_zip_to_file(zip_path, folder_path or "/")
+        zf = zipfile.ZipFile(zip_path)
+    except Exception as e:
+        os.unlink(zip_path)
+        logger.warning("Zip download unavailable, downloading files one by one: %s", e)
+        return None
+    # Member names start with the downloaded folder's own name
+    members = {
+        name.split('/', 1)[1].lower(): name
+        for name in zf.namelist() if '/' in name and not name.endswith('/')
+    }
+    return zf, members
 
-    return documents
+
+def _close_archive(archive):
+    zf, _ = archive
+    zf.close()
+    os.unlink(zf.filename)
+
+
+def _reuse_document(prior_docs, entry):
+    """Return the prior scan's document for entry if its content is unchanged."""
+    doc = prior_docs.get(entry.path_display.lstrip('/'))
+    if doc and entry.content_hash and doc.get('content_hash') == entry.content_hash:
+        return doc
+    return None
+
+
+def _fetch_document(dbx, entry, folder_path="", archive=None, scanned_at=None, strict=False):
+    """Download one Dropbox file and extract its text; returns a document dict or None.
+
+    Extracted text is cached on disk by Dropbox content hash, so unchanged
+    files skip both the download and the (PDF/OCR) extraction. Files found
+    in archive (from _download_zip) are read from it instead of downloaded.
+    """
+    ext = Path(entry.name).suffix.lower()
+    handler = HANDLERS.get(ext)
+    rel_path = entry.path_display.lstrip('/')
+    folder = rel_path.rpartition('/')[0] or 'root'
+
+    try:
+        text = _read_cached_text(entry.content_hash) if entry.content_hash else None
+        if text is None:
+            content = _read_from_archive(archive, folder_path, entry) if archive else None
+            if content is None:
+                _, response = dbx.files_download(entry.path_lower)
+                content = response.content
+            text = handler(content)
+
+            if text and text.strip() and entry.content_hash:
+                _write_cached_text(entry.content_hash, text)
+
+        if text and text.strip():
+            return {
+                'path': rel_path,
+                'folder': folder,
+                'filename': entry.name,
+                'type': ext,
+                'text': text.strip(),
+                'scanned_at': scanned_at or datetime.now().isoformat(),
+                'size_bytes': entry.size,
+                'content_hash': entry.content_hash,
+            }
+    except Exception as e:
+        # Handlers swallow their own parse errors, so this is a failed download
+        if strict:
+            raise
+        logger.warning("Error processing %s: %s", entry.name, e)
+    return None
+
+
+def _read_from_archive(archive, folder_path, entry):
+    zf, members = archive
+    member = members.get(entry.path_lower[len(folder_path):].lstrip('/'))
+    return zf.read(member) if member else None
 
 
 def upload_to_dropbox(dbx, file_bytes, filename, folder_path=""):
@@ -188,10 +538,12 @@ def upload_to_dropbox(dbx, file_bytes, filename, folder_path=""):
 
 
 def get_dropbox_fingerprint(dbx, folder_path=""):
-    """Return a string fingerprint of the Dropbox folder state.
+    """Return a string fingerprint of the Dropbox documents.
 
     Built from sorted file paths, sizes, and content hashes so any
-    add/remove/modify of a file produces a different fingerprint.
+    add/remove/modify of a document produces a different fingerprint.
+    Files scan_dropbox ignores (like the app's own _app_data JSON) are left
+    out, so saving chat or reports doesn't invalidate cached scans.
     """
     try:
         result = dbx.files_list_folder(folder_path, recursive=True)
@@ -200,82 +552,307 @@ def get_dropbox_fingerprint(dbx, folder_path=""):
             result = dbx.files_list_folder_continue(result.cursor)
             entries.extend(result.entries)
 
-        files = [e for e in entries if isinstance(e, dropbox.files.FileMetadata)]
+        files = [e for e in entries if is_document(e)]
         parts = sorted(f"{f.path_lower}:{f.size}:{f.content_hash}" for f in files)
         return "|".join(parts)
     except Exception:
         return None
 
 
-def save_app_data(dbx, filename, data):
-    """Save JSON data to Dropbox _app_data folder."""
-    content = json.dumps(data, indent=2).encode("utf-8")
+LONGPOLL_TIMEOUT = 480  # seconds; the maximum Dropbox allows
+LONGPOLL_RETRY = 30
+
+
+def _is_cursor_reset(error):
+    """True for an ApiError saying a list_folder cursor is no longer valid."""
+    return (
+        isinstance(error, dropbox.exceptions.ApiError)
+        and getattr(error.error, "is_reset", lambda: False)()
+    )
+
+
+def watch_dropbox(dbx, on_change, folder_path=""):
+    """Start a daemon thread that long-polls Dropbox and calls on_change() on document changes.
+
+    Uses files/list_folder/longpoll, which blocks server-side until something
+    under folder_path changes, instead of re-listing the folder on a timer.
+    The cursor delta is then read so that changes which can't affect the
+    documents (the app's own _app_data saves) don't trigger a reload.
+    """
+    def run():
+        cursor = None
+        while True:
+            try:
+                if cursor is None:
+                    cursor = dbx.files_list_folder_get_latest_cursor(
+                        folder_path, recursive=True
+                    ).cursor
+                result = dbx.files_list_folder_longpoll(cursor, timeout=LONGPOLL_TIMEOUT)
+                if result.changes:
+                    page = dbx.files_list_folder_continue(cursor)
+                    changed = any(_affects_documents(e) for e in page.entries)
+                    while page.has_more:
+                        page = dbx.files_list_folder_continue(page.cursor)
+                        changed = changed or any(_affects_documents(e) for e in page.entries)
+                    cursor = page.cursor
+                    if changed:
+                        on_change()
+                if result.backoff:
+                    time.sleep(result.backoff)
+            except Exception as e:
+                if _is_cursor_reset(e):
+                    # The cursor expired; changes since it can't be read, so
+                    # start over from a fresh one and have everything rescanned
+                    logger.warning("Dropbox cursor reset, rescanning: %s", e)
+                    cursor = None
+                    on_change()
+                    continue
+                # Keep the cursor so the retry still sees changes made meanwhile
+                logger.warning("Dropbox longpoll error: %s", e)
+                time.sleep(LONGPOLL_RETRY)
+
+    thread = threading.Thread(target=run, name="dropbox-longpoll", daemon=True)
+    thread.start()
+    return thread
+
+
+SAVE_DEBOUNCE = 0.5  # seconds to wait for more saves before uploading
+SAVE_RETRY = 30  # seconds before retrying uploads that failed
+
+_pending_saves = {}
+_pending_lock = threading.Lock()
+_pending_event = threading.Event()
+_flush_lock = threading.Lock()
+_writer_thread = None
+
+
+def _encode_app_data(data):
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+
+def _decode_app_data(content):
+    return orjson.loads(content) if orjson else json.loads(content)
+
+
+def _upload_app_data(dbx, filename, content):
+    # Stored gzipped (mtime=0 keeps identical data byte-identical)
     dbx.files_upload(
-        content,
-        f"/_app_data/{filename}",
+        gzip.compress(content, mtime=0),
+        f"/_app_data/{filename}.gz",
         mode=dropbox.files.WriteMode.overwrite,
     )
 
 
+def save_app_data(dbx, filename, data):
+    """Save JSON data to Dropbox _app_data folder."""
+    _upload_app_data(dbx, filename, _encode_app_data(data))
+
+
+def save_app_data_async(dbx, filename, data):
+    """Queue JSON data for upload by the background writer.
+
+    Data is serialized immediately so later mutations don't leak into the
+    upload; repeated saves of the same file before a flush collapse into one.
+    """
+    global _writer_thread
+    content = _encode_app_data(data)
+    with _pending_lock:
+        _pending_saves[filename] = (dbx, content)
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(
+                target=_run_writer, name="dropbox-writer", daemon=True
+            )
+            _writer_thread.start()
+    _pending_event.set()
+
+
+def flush_app_data():
+    """Upload every queued save now; returns False if any upload failed.
+
+    Failed files go back in the queue for the next flush, unless a newer
+    version of the same file was queued in the meantime.
+    """
+    ok = True
+    with _flush_lock:
+        with _pending_lock:
+            pending = dict(_pending_saves)
+            _pending_saves.clear()
+        for filename, (dbx, content) in pending.items():
+            try:
+                _upload_app_data(dbx, filename, content)
+            except Exception as e:
+                logger.warning("Error saving %s, will retry: %s", filename, e)
+                with _pending_lock:
+                    _pending_saves.setdefault(filename, (dbx, content))
+                ok = False
+    return ok
+
+
+def _run_writer():
+    while True:
+        _pending_event.wait()
+        time.sleep(SAVE_DEBOUNCE)
+        _pending_event.clear()
+        if not flush_app_data():
+            time.sleep(SAVE_RETRY)
+            _pending_event.set()
+
+
+atexit.register(flush_app_data)
+
+
+def _is_not_found(error):
+    """True for an ApiError saying the requested path doesn't exist."""
+    return (
+        isinstance(error, dropbox.exceptions.ApiError)
+        and error.error.is_path()
+        and error.error.get_path().is_not_found()
+    )
+
+
+def list_app_data(dbx, prefix=""):
+    """Return the sorted names of files in the Dropbox _app_data folder starting with prefix.
+
+    Names are as passed to save_app_data/load_app_data, without the .gz suffix.
+    Returns None if the folder couldn't be listed, so callers can tell a
+    failure from there being nothing saved yet.
+    """
+    try:
+        result = dbx.files_list_folder("/_app_data")
+        entries = list(result.entries)
+        while result.has_more:
+            result = dbx.files_list_folder_continue(result.cursor)
+            entries.extend(result.entries)
+    except Exception as e:
+        if _is_not_found(e):
+            return []  # nothing has been saved yet
+        return None
+    return sorted({
+        e.name.removesuffix(".gz") for e in entries
+        if isinstance(e, dropbox.files.FileMetadata) and e.name.startswith(prefix)
+    })
+
+
 def load_app_data(dbx, filename):
-    """Load JSON data from Dropbox _app_data folder."""
+    """Load JSON data from Dropbox _app_data folder.
+
+    Falls back to the uncompressed file written before app data was gzipped,
+    but only when no .gz exists: legacy files are never removed, so reading
+    one after a transient error would load stale data that the next save
+    then writes back over the current file.
+    """
+    try:
+        _, response = dbx.files_download(f"/_app_data/{filename}.gz")
+        return _decode_app_data(gzip.decompress(response.content))
+    except Exception as e:
+        if not _is_not_found(e):
+            logger.warning("Error loading %s: %s", filename, e)
+            return None
     try:
         _, response = dbx.files_download(f"/_app_data/{filename}")
-        return json.loads(response.content)
+        return _decode_app_data(response.content)
     except Exception:
         return None
 
 
-def parse_heirs(documents):
-    """Parse heir information from document text."""
+HEIRS_HEADER_RE = re.compile(r'eredi|heirs', re.IGNORECASE)
+ASSETS_HEADER_RE = re.compile(r'immobili|beni|properties|assets', re.IGNORECASE)
+SECTION_HEADER_RE = re.compile(r'eredi|heirs|immobili|beni|properties|assets', re.IGNORECASE)
+HEIR_NUMBER_RE = re.compile(r'^\d+[\.\)\s]+')
+HEIR_NAME_RE = re.compile(r'([A-Za-zÀ-ÿ]+)')
+HEIR_DOB_RE = re.compile(r'\((\d{2}/\d{2}/\d{4})\)')
+HEIR_CHILDREN_RE = re.compile(r'(\d+)\s+figli[oa]?e?')
+HEIR_STATUS_RE = re.compile(r'coniugat|libero|vedov')  # "stato libero" contains "libero"
+
+# In priority order, for lines that mention more than one status
+MARITAL_STATUSES = [
+    ('coniugat', 'married', 'coniugato/a'),
+    ('libero', 'unmarried', 'stato libero'),
+    ('vedov', 'widowed', 'vedovo/a'),
+]
+
+
+def _lines_from(text, header_re):
+    """Yield the lines of text, starting at the first line matching header_re.
+
+    Lines before the first section header can't produce entries, so the
+    parsers skip them (and whole documents without a header) outright.
+    Lines are sliced one at a time rather than split into a list up front.
+    """
+    match = header_re.search(text)
+    if not match:
+        return
+    start = text.rfind('\n', 0, match.start()) + 1
+    while (end := text.find('\n', start)) != -1:
+        yield text[start:end]
+        start = end + 1
+    yield text[start:]
+
+
+def parse_documents(documents):
+    """Parse heirs and assets from document text in one pass; returns (heirs, assets).
+
+    Each line is walked once and fed to both section state machines.
+    """
     heirs = []
+    assets = []
     for doc in documents:
-        text = doc['text']
-        lines = text.split('\n')
         in_heirs = False
-        for line in lines:
+        in_assets = False
+        for line in _lines_from(doc['text'], SECTION_HEADER_RE):
             line = line.strip()
-            if 'eredi' in line.lower() or 'heirs' in line.lower():
+            if HEIRS_HEADER_RE.search(line):
                 in_heirs = True
-                continue
-            if in_heirs and line and line[0].isdigit():
+            elif in_heirs and line and line[0].isdigit():
                 heir = parse_heir_line(line)
                 if heir:
                     heir['source_file'] = doc['path']
                     heirs.append(heir)
-            elif in_heirs and ('immobili' in line.lower() or 'beni' in line.lower() or line == ''):
-                if line and 'immobili' in line.lower():
-                    in_heirs = False
-    return heirs
+            elif in_heirs and line and 'immobili' in line.lower():
+                in_heirs = False
+
+            if ASSETS_HEADER_RE.search(line):
+                in_assets = True
+            elif in_assets and line:
+                assets.append({
+                    'description': line.rstrip(';').strip(),
+                    'source_file': doc['path'],
+                    'raw_text': line,
+                })
+    return heirs, assets
+
+
+def parse_heirs(documents):
+    """Parse heir information from document text."""
+    return parse_documents(documents)[0]
 
 
 def parse_heir_line(line):
     """Parse a single heir line."""
-    line = re.sub(r'^\d+[\.\)\s]+', '', line).strip()
+    line = HEIR_NUMBER_RE.sub('', line).strip()
     if not line:
         return None
 
     heir = {}
 
-    name_match = re.match(r'([A-Za-zÀ-ÿ]+)', line)
+    name_match = HEIR_NAME_RE.match(line)
     if name_match:
         heir['name'] = name_match.group(1)
 
-    dob_match = re.search(r'\((\d{2}/\d{2}/\d{4})\)', line)
+    dob_match = HEIR_DOB_RE.search(line)
     if dob_match:
         heir['date_of_birth'] = dob_match.group(1)
 
-    if 'coniugat' in line.lower():
-        heir['marital_status'] = 'married'
-        heir['marital_status_it'] = 'coniugato/a'
-    elif 'stato libero' in line.lower() or 'libero' in line.lower():
-        heir['marital_status'] = 'unmarried'
-        heir['marital_status_it'] = 'stato libero'
-    elif 'vedov' in line.lower():
-        heir['marital_status'] = 'widowed'
-        heir['marital_status_it'] = 'vedovo/a'
-
-    children_match = re.search(r'(\d+)\s+figli[oa]?e?', line)
+    found = set(HEIR_STATUS_RE.findall(line.lower()))
+    for keyword, status, status_it in MARITAL_STATUSES:
+        if keyword in found:
+            heir['marital_status'] = status
+            heir['marital_status_it'] = status_it
+            break
+
+    children_match = HEIR_CHILDREN_RE.search(line)
     if children_match:
         heir['num_children'] = int(children_match.group(1))
 
@@ -286,20 +863,4 @@ def parse_heir_line(line):
 
 def parse_assets(documents):
     """Parse asset/property information from document text."""
-    assets = []
-    for doc in documents:
-        text = doc['text']
-        lines = text.split('\n')
-        in_assets = False
-        for line in lines:
-            line = line.strip()
-            if any(kw in line.lower() for kw in ['immobili', 'beni', 'properties', 'assets']):
-                in_assets = True
-                continue
-            if in_assets and line:
-                assets.append({
-                    'description': line.rstrip(';').strip(),
-                    'source_file': doc['path'],
-                    'raw_text': line,
-                })
-    return assets
+    return parse_documents(documents)[1]